@@ -1,12 +1,16 @@
 """
 Image classes
 """
-import base64
 import json
 import logging
+import os
 import zipfile
 from io import StringIO
-from urllib.parse import quote_plus
+from typing import List
+from urllib.parse import (
+    quote_plus,
+    urlencode,
+)
 
 import mrcfile
 import numpy as np
@@ -27,8 +31,24 @@ from galaxy.util.image_util import check_image_type
 from . import data
 from .xml import GenericXml
 
+# optional import for SIMD accelerated base64 encoding, pybase64 is not a
+# Galaxy requirement so fall back to the standard library implementation
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
 log = logging.getLogger(__name__)
 
+# Accepted magic strings of NIfTI-1 (at offset 344) and NIfTI-2 (at offset 4)
+# headers.
+_NII1_MAGIC = frozenset((b'n+1\0',))
+_NII2_MAGIC = frozenset((b'n+2\0', b'ni2\0'))
+
+# The first three lines of a Gifti file must start within this many bytes;
+# splitting only these avoids copying the rest of the (up to 1 MB) sniff prefix.
+GIFTI_HEADER_BYTES = 2048
+
 # TODO: Uploading image files of various types is supported in Galaxy, but on
 # the main public instance, the display_in_upload is not set for these data
 # types in datatypes_conf.xml because we do not allow image files to be uploaded
@@ -45,10 +65,15 @@ class Image(data.Data):
     edam_data = 'data_2968'
     edam_format = "format_3547"
     file_ext = ''
+    image_formats: List[str] = []
 
-    def __init__(self, **kwd):
-        super().__init__(**kwd)
-        self.image_formats = [self.file_ext.upper()]
+    def __init_subclass__(cls, **kwd):
+        super().__init_subclass__(**kwd)
+        # Only derive image_formats for classes defining their own file_ext, so
+        # subclasses without one (e.g. those built by the registry for
+        # subclass="true" datatypes) keep their parent's list, such as Jpg's.
+        if 'file_ext' in cls.__dict__ and 'image_formats' not in cls.__dict__:
+            cls.image_formats = [cls.file_ext.upper()] if cls.file_ext else []
 
     def set_peek(self, dataset):
         if not dataset.dataset.purged:
@@ -62,21 +87,22 @@ class Image(data.Data):
         """Determine if the file is in this format"""
         return check_image_type(filename, self.image_formats)
 
-    def handle_dataset_as_image(self, hda):
+    def handle_dataset_as_image(self, hda, max_embed_bytes=data.DEFAULT_MAX_PEEK_SIZE):
+        """Embed the image as a base64 data URI, or a short note if it is larger than max_embed_bytes."""
         dataset = hda.dataset
         name = hda.name or ''
         with open(dataset.file_name, "rb") as f:
-            base64_image_data = base64.b64encode(f.read()).decode("utf-8")
+            size = os.fstat(f.fileno()).st_size
+            if size > max_embed_bytes:
+                return f"*image too large to embed ({nice_size(size)})*\n"
+            base64_image_data = b64encode(f.read()).decode("ascii")
         return f"![{name}](data:image/{self.file_ext};base64,{base64_image_data})"
 
 
 class Jpg(Image):
     edam_format = "format_3579"
     file_ext = "jpg"
-
-    def __init__(self, **kwd):
-        super().__init__(**kwd)
-        self.image_formats = ['JPEG']
+    image_formats = ['JPEG']
 
 
 class Png(Image):
@@ -197,35 +223,45 @@ class Rast(Image):
     file_ext = "rast"
 
 
+@build_sniff_from_prefix
 class Pdf(Image):
     edam_format = "format_3508"
     file_ext = "pdf"
 
-    def sniff(self, filename):
-        """Determine if the file is in pdf format."""
-        with open(filename, 'rb') as fh:
-            return fh.read(4) == b"%PDF"
+    def sniff_prefix(self, file_prefix: FilePrefix):
+        """Determine if the file is in pdf format.
+
+        >>> from galaxy.datatypes.sniff import get_test_fname
+        >>> fname = get_test_fname('454Score.pdf')
+        >>> Pdf().sniff(fname)
+        True
+        >>> fname = get_test_fname('2.txt')
+        >>> Pdf().sniff(fname)
+        False
+        """
+        return file_prefix.startswith_bytes(b"%PDF")
 
 
-def create_applet_tag_peek(class_name, archive, params):
-    text = f"""
+APPLET_TAG_PEEK_TEMPLATE = """<div><p align="center">
 <object classid="java:{class_name}"
       type="application/x-java-applet"
       height="30" width="200" align="center" >
-      <param name="archive" value="{archive}"/>"""
-    for name, value in params.items():
-        text += f"""<param name="{name}" value="{value}"/>"""
-    text += f"""
+      <param name="archive" value="{archive}"/>{param_tags}
 <object classid="clsid:8AD9C840-044E-11D1-B3E9-00805F499D93"
         height="30" width="200" >
         <param name="code" value="{class_name}" />
-        <param name="archive" value="{archive}"/>"""
-    for name, value in params.items():
-        text += f"""<param name="{name}" value="{value}"/>"""
-    text += """<div class="errormessage">You must install and enable Java in your browser in order to access this applet.<div></object>
+        <param name="archive" value="{archive}"/>{param_tags}<div class="errormessage">You must install and enable Java in your browser in order to access this applet.<div></object>
 </object>
-"""
-    return f"""<div><p align="center">{text}</p></div>"""
+</p></div>"""
+
+
+def create_applet_tag_peek(class_name, archive, params):
+    param_tags = "".join(f"""<param name="{name}" value="{value}"/>""" for name, value in params.items())
+    return APPLET_TAG_PEEK_TEMPLATE.format_map({
+        "class_name": class_name,
+        "archive": archive,
+        "param_tags": param_tags,
+    })
 
 
 @build_sniff_from_prefix
@@ -353,21 +389,22 @@ class Gmaj(data.Data):
     edam_format = "format_3547"
     file_ext = "gmaj.zip"
     copy_safe_peek = False
+    applet_class_name = "edu.psu.bx.gmaj.MajApplet.class"
+    applet_archive = "/static/gmaj/gmaj.jar"
 
     def set_peek(self, dataset):
         if not dataset.dataset.purged:
             if hasattr(dataset, 'history_id'):
+                query = urlencode([('copy_access_from', dataset.id), ('history_id', dataset.history_id), ('ext', 'maf'), ('name', f'GMAJ Output on data {dataset.hid}'), ('info', 'Added by GMAJ'), ('dbkey', dataset.dbkey)])
                 params = {
                     "bundle": f"display?id={dataset.id}&tofile=yes&toext=.zip",
                     "buttonlabel": "Launch GMAJ",
                     "nobutton": "false",
                     "urlpause": "100",
                     "debug": "false",
-                    "posturl": "history_add_to?%s" % "&".join(f"{x[0]}={quote_plus(str(x[1]))}" for x in [('copy_access_from', dataset.id), ('history_id', dataset.history_id), ('ext', 'maf'), ('name', f'GMAJ Output on data {dataset.hid}'), ('info', 'Added by GMAJ'), ('dbkey', dataset.dbkey)])
+                    "posturl": f"history_add_to?{query}"
                 }
-                class_name = "edu.psu.bx.gmaj.MajApplet.class"
-                archive = "/static/gmaj/gmaj.jar"
-                dataset.peek = create_applet_tag_peek(class_name, archive, params)
+                dataset.peek = create_applet_tag_peek(self.applet_class_name, self.applet_archive, params)
                 dataset.blurb = 'GMAJ Multiple Alignment Viewer'
             else:
                 dataset.peek = "After you add this item to your history, you will be able to launch the GMAJ applet."
@@ -391,18 +428,35 @@ class Gmaj(data.Data):
         NOTE: the sniff.convert_newlines() call in the upload utility will keep Gmaj data types from being
         correctly sniffed, but the files can be uploaded (they'll be sniffed as 'txt').  This sniff function
         is here to provide an example of a sniffer for a zip file.
+
+        A zip file is a Gmaj file if one of its members has a '.gmaj' extension.
+        Only files starting with a zip local file header are considered, zip
+        archives with data prepended to them (e.g. self-extracting archives) are
+        not sniffed as Gmaj even though zipfile.is_zipfile() accepts them.
+
+        >>> from galaxy.datatypes.sniff import get_test_fname
+        >>> fname = get_test_fname('1.gmaj.zip')
+        >>> Gmaj().sniff(fname)
+        True
+        >>> fname = get_test_fname('gmaj_not_suffix.zip')
+        >>> Gmaj().sniff(fname)
+        False
+        >>> fname = get_test_fname('prefixed.gmaj.zip')
+        >>> Gmaj().sniff(fname)
+        False
+        >>> fname = get_test_fname('2.txt')
+        >>> Gmaj().sniff(fname)
+        False
         """
-        if not zipfile.is_zipfile(filename):
-            return False
-        contains_gmaj_file = False
-        with zipfile.ZipFile(filename, "r") as zip_file:
-            for name in zip_file.namelist():
-                if name.split(".")[1].strip().lower() == 'gmaj':
-                    contains_gmaj_file = True
-                    break
-        if not contains_gmaj_file:
-            return False
-        return True
+        with open(filename, 'rb') as fh:
+            if fh.read(4) != b'PK\x03\x04':
+                return False
+            fh.seek(0)
+            try:
+                with zipfile.ZipFile(fh, "r") as zip_file:
+                    return any(name[-5:].lower() == '.gmaj' for name in zip_file.namelist())
+            except zipfile.BadZipFile:
+                return False
 
 
 class Analyze75(Binary):
@@ -469,10 +523,7 @@ class Nifti1(Binary):
     file_ext = 'nii1'
 
     def sniff_prefix(self, file_prefix: FilePrefix):
-        magic = file_prefix.contents_header_bytes[344:348]
-        if magic == b'n+1\0':
-            return True
-        return False
+        return file_prefix.contents_header_bytes[344:348] in _NII1_MAGIC
 
 
 @build_sniff_from_prefix
@@ -492,10 +543,7 @@ class Nifti2(Binary):
     file_ext = 'nii2'
 
     def sniff_prefix(self, file_prefix: FilePrefix):
-        magic = file_prefix.contents_header_bytes[4:8]
-        if magic in [b'n+2\0', b'ni2\0']:
-            return True
-        return False
+        return file_prefix.contents_header_bytes[4:8] in _NII2_MAGIC
 
 
 @build_sniff_from_prefix
@@ -520,15 +568,14 @@ class Gifti(GenericXml):
         >>> Gifti().sniff(fname)
         False
         """
-        handle = file_prefix.string_io()
-        line = handle.readline()
-        if not line.strip().startswith('<?xml version="1.0"'):
+        # Only the first three lines are inspected, match them as bytes rather
+        # than building a StringIO over the decoded prefix.
+        lines = [line.strip() for line in file_prefix.contents_header_bytes[:GIFTI_HEADER_BYTES].split(b'\n', 3)[:3]]
+        if not lines[0].startswith(b'<?xml version="1.0"'):
             return False
-        line = handle.readline()
-        if line.strip() == '<!DOCTYPE GIFTI SYSTEM "http://www.nitrc.org/frs/download.php/1594/gifti.dtd">':
+        if len(lines) > 1 and lines[1] == b'<!DOCTYPE GIFTI SYSTEM "http://www.nitrc.org/frs/download.php/1594/gifti.dtd">':
             return True
-        line = handle.readline()
-        if line.strip().startswith('<GIFTI'):
+        if len(lines) > 2 and lines[2].startswith(b'<GIFTI'):
             return True
         return False
 
@@ -595,20 +642,21 @@ class Laj(data.Text):
     """Class describing a LAJ Applet"""
     file_ext = "laj"
     copy_safe_peek = False
+    applet_class_name = "edu.psu.cse.bio.laj.LajApplet.class"
+    applet_archive = "/static/laj/laj.jar"
 
     def set_peek(self, dataset):
         if not dataset.dataset.purged:
             if hasattr(dataset, 'history_id'):
+                query = '&'.join(f'{key}={value}' for key, value in {'history_id': dataset.history_id, 'ext': 'lav', 'name': 'LAJ Output', 'info': 'Added by LAJ', 'dbkey': dataset.dbkey, 'copy_access_from': dataset.id}.items())
                 params = {
                     "alignfile1": f"display?id={dataset.id}",
                     "buttonlabel": "Launch LAJ",
                     "title": "LAJ in Galaxy",
-                    "posturl": quote_plus(f"history_add_to?{'&'.join(f'{key}={value}' for key, value in {'history_id': dataset.history_id, 'ext': 'lav', 'name': 'LAJ Output', 'info': 'Added by LAJ', 'dbkey': dataset.dbkey, 'copy_access_from': dataset.id}.items())}"),
+                    "posturl": quote_plus(f"history_add_to?{query}"),
                     "noseq": "true"
                 }
-                class_name = "edu.psu.cse.bio.laj.LajApplet.class"
-                archive = "/static/laj/laj.jar"
-                dataset.peek = create_applet_tag_peek(class_name, archive, params)
+                dataset.peek = create_applet_tag_peek(self.applet_class_name, self.applet_archive, params)
             else:
                 dataset.peek = "After you add this item to your history, you will be able to launch the LAJ applet."
                 dataset.blurb = 'LAJ Multiple Alignment Viewer'
@@ -278,6 +278,11 @@ class ConditionalDependencies:
     def check_keras(self):
         return asbool(self.config["enable_tool_recommendations"])
 
+    def check_pybase64(self):
+        # Optional speedup, galaxy.datatypes.images falls back to the stdlib
+        # base64 module when it is not installed.
+        return True
+
     def check_tensorflow(self):
         return asbool(self.config["enable_tool_recommendations"])
 
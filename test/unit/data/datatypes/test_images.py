@@ -0,0 +1,89 @@
+import base64
+import os
+import tempfile
+
+from galaxy.datatypes.data import DEFAULT_MAX_PEEK_SIZE
+from galaxy.datatypes.images import (
+    Gmaj,
+    Jpg,
+    Laj,
+    OMETiff,
+    Png,
+)
+from galaxy.util import galaxy_directory
+from .util import MockDataset
+
+
+def test_image_formats():
+    assert Png().image_formats == ['PNG']
+    assert Jpg().image_formats == ['JPEG']
+    assert OMETiff().image_formats == ['OME.TIFF']
+
+
+def test_image_formats_registry_subclass():
+    # The datatypes registry creates subclasses like this for subclass="true" entries.
+    jpg_subclass = type('Jpg', (Jpg, ), {})
+    assert jpg_subclass().image_formats == ['JPEG']
+
+
+class MockPeekDataset:
+
+    def __init__(self):
+        self.id = 1
+        self.history_id = 2
+        self.hid = 3
+        self.dbkey = "hg19"
+        self.dataset = MockDataset(id=1)
+        self.dataset.purged = False
+
+
+def test_gmaj_set_peek():
+    dataset = MockPeekDataset()
+    Gmaj().set_peek(dataset)
+    assert dataset.peek.startswith('<div><p align="center">\n<object classid="java:edu.psu.bx.gmaj.MajApplet.class"')
+    assert dataset.peek.count('<param name="archive" value="/static/gmaj/gmaj.jar"/>') == 2
+    posturl = '<param name="posturl" value="history_add_to?copy_access_from=1&history_id=2&ext=maf&name=GMAJ+Output+on+data+3&info=Added+by+GMAJ&dbkey=hg19"/>'
+    assert dataset.peek.count(posturl) == 2
+    assert dataset.blurb == 'GMAJ Multiple Alignment Viewer'
+
+
+def test_laj_set_peek():
+    dataset = MockPeekDataset()
+    Laj().set_peek(dataset)
+    assert dataset.peek.startswith('<div><p align="center">\n<object classid="java:edu.psu.cse.bio.laj.LajApplet.class"')
+    assert dataset.peek.count('<param name="archive" value="/static/laj/laj.jar"/>') == 2
+    posturl = '<param name="posturl" value="history_add_to%3Fhistory_id%3D2%26ext%3Dlav%26name%3DLAJ+Output%26info%3DAdded+by+LAJ%26dbkey%3Dhg19%26copy_access_from%3D1"/>'
+    assert dataset.peek.count(posturl) == 2
+
+
+class MockHda:
+
+    def __init__(self, file_name):
+        self.name = "image"
+        self.dataset = MockDataset(id=1)
+        self.dataset.file_name = file_name
+
+
+def test_handle_dataset_as_image():
+    with tempfile.NamedTemporaryFile() as image:
+        image.write(b"\x89PNG" * 4)
+        image.flush()
+        hda = MockHda(image.name)
+        encoded = base64.b64encode(b"\x89PNG" * 4).decode("ascii")
+        assert Png().handle_dataset_as_image(hda) == f"![image](data:image/png;base64,{encoded})"
+        # images of exactly max_embed_bytes are still embedded
+        assert Png().handle_dataset_as_image(hda, max_embed_bytes=16) == f"![image](data:image/png;base64,{encoded})"
+        assert Png().handle_dataset_as_image(hda, max_embed_bytes=15) == "*image too large to embed (16 bytes)*\n"
+
+
+def test_handle_dataset_as_image_over_default_limit():
+    with tempfile.NamedTemporaryFile() as image:
+        image.write(b"\0" * (DEFAULT_MAX_PEEK_SIZE + 1))
+        image.flush()
+        hda = MockHda(image.name)
+        assert Jpg().handle_dataset_as_image(hda) == "*image too large to embed (976.6 KB)*\n"
+
+
+def test_gmaj_sniff_zip_members_without_extension():
+    # testdir1.zip has directory and file members without a '.', which used to raise an IndexError
+    assert Gmaj().sniff(os.path.join(galaxy_directory(), 'test-data/testdir1.zip')) is False